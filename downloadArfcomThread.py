@@ -1,16 +1,61 @@
 from __future__ import annotations
 import re
 import argparse
+import queue
+import threading
+from collections import deque
+from functools import lru_cache
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html
 
 import sqlite3
 from sqlite3 import Error
+from contextlib import closing
 
+import numpy as np
 import pandas as pd
 import seaborn as sb
 import matplotlib.pyplot as plt
 
+# Number of posts to buffer before writing them to the database
+INSERT_BATCH_SIZE = 1000
+# Number of posts per insert statement, 5 values each keeps us under
+# sqlite's default limit of 999 bound parameters
+INSERT_ROWS_PER_STATEMENT = 100
+# Number of pages to download at the same time
+FETCH_WORKERS = 16
+# Number of downloaded pages allowed to wait for processing
+FETCH_QUEUE_SIZE = 32
+# Seconds between checks for a stopped consumer while the page queue is full
+FETCH_STOP_POLL = 1
+# Bytes read from the network at a time while parsing a page
+FETCH_CHUNK_SIZE = 64 * 1024
+
+# XPath queries used on every page and post, compiled once up front
+_POST_XP = etree.XPath(
+    ".//div[normalize-space(@class)='expanded row']")
+_ID_XP = etree.XPath(
+    ".//div[normalize-space(@class)='small-2 large-6 columns text-right']")
+_TIME_XP = etree.XPath(
+    ".//div[contains(concat(' ', normalize-space(@class), ' '), ' timestamp ')]")
+# Text nodes of the first body div, returned as plain strings rather than
+# lxml's smart strings that keep a reference back to their element
+_BODY_TEXT_XP = etree.XPath(
+    "(.//div[contains(concat(' ', normalize-space(@class), ' '), ' body ')])[1]//text()",
+    smart_strings=False)
+_PAGES_XP = etree.XPath(
+    ".//select[contains(concat(' ', normalize-space(@class), ' '), ' pages ')]")
+
+# Raw bytes that show up in a page with posts in it
+_POST_MARKER = b'expanded row'
+
+# Post number within a page, shown as [#<integer>]
+_POST_ID_RE = re.compile(r'\[#(\d+)\]')
+
 
 def sql_connection(db) -> sqlite3.Connection:
     ''' Create an sql connection given a database name '''
@@ -21,112 +66,253 @@ def sql_connection(db) -> sqlite3.Connection:
         print(Error)
 
 
-def sql_table(con) -> None:
+def sql_table(cursorObj) -> None:
     ''' Create an sql table that we will put all the posts from thread into '''
-    cursorObj = con.cursor()
+    # No primary key here, the unique id index is built by sql_index after
+    # the bulk load so inserts don't have to keep it up to date
     cursorObj.execute(
-        "CREATE TABLE posts(id integer PRIMARY KEY, author text, time text, postText text, page integer)")
-    con.commit()
+        "CREATE TABLE posts(id integer, author text, time text, postText text, page integer)")
+    cursorObj.connection.commit()
 
 
-def sql_insert(con, entities) -> None:
-    ''' Insert post info into database '''
-    cursorObj = con.cursor()
-    cursorObj.execute(
-        'INSERT INTO posts(id, author, time, postText, page) VALUES(?, ?, ?, ?, ?)', entities)
-    con.commit()
+def sql_pragmas(con) -> None:
+    ''' Tune the sqlite connection for a single writer bulk load. The exclusive
+        lock is held until the connection is closed, so close it before reading
+    '''
+    con.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-200000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA locking_mode=EXCLUSIVE;
+    ''')
+
+
+@lru_cache
+def sql_insert_statement(rows) -> str:
+    ''' Build an insert statement for the given number of posts. Cached so the
+        string isn't rebuilt for every chunk, sqlite3 already reuses the
+        prepared statement for equal sql text
+    '''
+    return 'INSERT INTO posts(id, author, time, postText, page) VALUES ' + \
+        ', '.join(['(?, ?, ?, ?, ?)'] * rows)
 
 
-class Post():
-    ''' Post class: 
-        Contains info for each individual post
-        Each post has an id number, a page number, an author, a posttime and post text 
-    '''
+def sql_insert(cursorObj, entities) -> None:
+    ''' Insert a batch of post info tuples into database in a single transaction '''
+    if not entities:
+        return
+    cursorObj.execute('BEGIN')
+    # Insert many rows per statement, the last chunk may be shorter than the rest
+    for start in range(0, len(entities), INSERT_ROWS_PER_STATEMENT):
+        chunk = entities[start:start + INSERT_ROWS_PER_STATEMENT]
+        cursorObj.execute(sql_insert_statement(len(chunk)),
+                          list(chain.from_iterable(chunk)))
+    cursorObj.connection.commit()
 
-    def __init__(self, post, pagenum) -> None:
-        ''' Create an instance of a Post given html text and page number '''
-
-        # Init everything to None except our given page number
-        self.id = None
-        self.page = int(pagenum)
-        self.author = None
-        self.time = None
-        self.text = None
-
-        # If we somehow called a Post without actually having html text passed
-        if not post:
-            return None
-
-        # Go through post html and acquire post data
-        self.getPostID(post)
-        self.getAuthor(post)
-        self.getTime(post)
-        self.getText(post)
-
-    def getPostID(self, post) -> None:
-        ''' Find post number 1-50 in page text '''
-
-        # First find all tags that match the post number config
-        idNumPost = post.find_all(
-            'div', class_='small-2 large-6 columns text-right')
-
-        # Loop over all these tags - not all are post nums
-        for idv in idNumPost:
-            # search for a text pattern matching [#<integer>]
-            idf = re.search('[\#[0-9]+]', idv.text)
-            if idf:
-                # If we find it and if this text starts with '['
-                if idf.group()[0] == '[':
-                    # then extract the number as the post number for the page
-                    # add 50*(page_number -1) to get the post number in the
-                    # entire thread. This is our post id
-                    self.id = 50*(self.page - 1) + int(idf.group()[2:-1])
-
-    def getAuthor(self, post) -> None:
-        ''' Get post author from post html text '''
-
-        # Check for anchor tag with author
-        try:
-            self.author = post.find('a').text.strip()
-        # If we can't find it then this is not a valid post
-        except AttributeError:
-            self.author = None
 
-        # If author name len is 0 or neg, set to None - not a valid post
-        if len(self.author) <= 0:
-            self.author = None
+def sql_index(cursorObj) -> None:
+    ''' Create the post id and analysis indices, after the posts are loaded '''
+    cursorObj.execute('CREATE UNIQUE INDEX idx_posts_id ON posts(id)')
+    cursorObj.execute('CREATE INDEX idx_posts_author ON posts(author)')
+    cursorObj.execute('CREATE INDEX idx_posts_time ON posts(time)')
+    cursorObj.connection.commit()
 
-    def getTime(self, post) -> None:
-        ''' Get post time from post html text '''
 
-        try:
-            # Keep time as a string for now
-            timestr = post.find(
-                'div', class_='timestamp').contents[1].text.strip()
-            self.time = " ".join(timestr.split()[1:-1])
-        # if we run into errors getting time from text, we likely are not looking
-        # at an actual post, so set time to None
-        except IndexError:
-            print('Post time not found')
-            self.time = None
-        except AttributeError:
-            print('Post time not found')
-            self.time = None
-
-        if len(self.time) <= 0:
-            # One final check of time to ensure we extracted it correctly
-            self.time = None
-
-    def getText(self, post) -> None:
-        ''' Get post text from post html text '''
-        try:
-            self.text = post.find('div', class_='body').text.strip()
-        except KeyError:
-            # If we can't find div with body class
-            self.text = None
+def post_id(post, page) -> int | None:
+    ''' Find post number 1-50 in post html and turn it into a thread post id '''
+    postID = None
+
+    # Loop over all tags that match the post number config - not all are post nums
+    for idv in _ID_XP(post):
+        # search for a text pattern matching [#<integer>]
+        idf = _POST_ID_RE.search(idv.text_content())
+        if idf:
+            # If we find it, extract the number as the post number for the page
+            # add 50*(page_number -1) to get the post number in the
+            # entire thread. This is our post id
+            postID = 50*(page - 1) + int(idf.group(1))
+    return postID
+
+
+def post_author(post) -> str | None:
+    ''' Get post author from post html '''
+
+    # Check for anchor tag with author
+    authorTag = post.find('.//a')
+    # If we can't find it then this is not a valid post
+    if authorTag is None:
+        return None
+    author = authorTag.text_content().strip()
+
+    # If author name is empty, return None - not a valid post
+    return author or None
+
+
+def post_time(post) -> str | None:
+    ''' Get post time from post html '''
+
+    try:
+        # Keep time as a string for now
+        timestr = _TIME_XP(post)[0][0].text_content().strip()
+    # if we run into errors getting time from text, we likely are not looking
+    # at an actual post, so return None
+    except IndexError:
+        print('Post time not found')
+        return None
 
-        # Don't return None for len(text) == 0, it may be an img or something
-        # stripped but is still a valid post
+    # One final check of time to ensure we extracted it correctly
+    return " ".join(timestr.split()[1:-1]) or None
+
+
+def post_text(post) -> str:
+    ''' Get post text from post html '''
+    # Joining the text nodes gives the same text as the whole div, and an
+    # empty string if there is no div with body class
+    return ''.join(_BODY_TEXT_XP(post)).strip()
+
+
+def parse_post(post, page) -> tuple | None:
+    ''' Extract a post from its html and page number as an
+        (id, author, time, text, page) row ready to insert into the database.
+        Returns None if any of the post components are missing
+    '''
+    # Stop as soon as a component is missing, it's not a valid post
+    postID = post_id(post, page)
+    if not postID:
+        return None
+    author = post_author(post)
+    if not author:
+        return None
+    time = post_time(post)
+    if not time:
+        return None
+    text = post_text(post)
+    if not text:
+        return None
+    return (postID, author, time, text, page)
+
+
+def page_posts(root, page) -> list[tuple]:
+    ''' Return the rows of all complete posts found in a parsed thread page '''
+    rows = []
+    # Loop over possible posts
+    for post in _POST_XP(root):
+        # Only complete posts are returned
+        row = parse_post(post, page)
+        if row:
+            rows.append(row)
+    return rows
+
+
+class ThreadEnded(Exception):
+    ''' Raised when a page shows there are no more posts in the thread '''
+
+
+def fetch_page(session, url) -> html.HtmlElement:
+    ''' Download a thread page and parse it as it arrives. Raises ThreadEnded
+        if the page is missing or has no posts, and HTTPError for any other
+        failed request
+    '''
+    with session.get(url, stream=True) as response:
+        # A missing page means the thread ended early, don't read the body
+        if response.status_code == 404:
+            raise ThreadEnded(f'{url} returned status 404')
+        # Anything else that isn't a normal page is an error, retryable
+        # statuses have already been retried by the session
+        if response.status_code != 200:
+            raise requests.HTTPError(
+                f'{url} returned status {response.status_code}', response=response)
+
+        # Hold on to the html until the raw bytes show post containers, then
+        # feed it to the parser chunk by chunk while the rest downloads.
+        # Pages without posts are never parsed
+        parser = html.HTMLParser()
+        found = False
+        head = []
+        tail = b''
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            if found:
+                parser.feed(chunk)
+                continue
+            head.append(chunk)
+            # Keep the end of what we've seen in case the marker spans chunks
+            found = _POST_MARKER in tail + chunk
+            tail = (tail + chunk)[-len(_POST_MARKER):]
+            if found:
+                for held in head:
+                    parser.feed(held)
+                head.clear()
+
+    # A page without any post containers means the thread ended early
+    if not found:
+        raise ThreadEnded(f'{url} has no posts in it')
+    return parser.close()
+
+
+def queue_put(pageQueue, item, stop) -> bool:
+    ''' Put an item on the queue, giving up if the consumer has stopped.
+        Returns whether the item was queued
+    '''
+    while not stop.is_set():
+        try:
+            pageQueue.put(item, timeout=FETCH_STOP_POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def fetch_pages(session, threadPage, pages, pageQueue, stop) -> None:
+    ''' Download and parse a range of thread pages concurrently and put
+        (page, root) on the queue in page order, stopping at the first page
+        without posts or once the stop event is set. Ends with (None, None),
+        or (None, exception) on failure
+    '''
+    try:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            pending = deque()
+            pageIter = iter(pages)
+            while not stop.is_set():
+                # Keep a window of downloads in flight, oldest page first
+                for page in islice(pageIter, FETCH_WORKERS - len(pending)):
+                    pending.append(
+                        (page, executor.submit(fetch_page, session, f'{threadPage}?page={page}')))
+                if not pending:
+                    break
+
+                page, future = pending.popleft()
+                try:
+                    root = future.result()
+                except ThreadEnded as e:
+                    # The thread is shorter than it was on the first page, so
+                    # posts may have been deleted while downloading
+                    print(f'WARNING: stopped at page {page} of {pages[-1]} '
+                          f'because {e}, later pages were not downloaded')
+                    break
+                if not queue_put(pageQueue, (page, root), stop):
+                    break
+
+            # Drop any downloads that haven't started if we stopped early
+            for _, future in pending:
+                future.cancel()
+    except Exception as e:
+        queue_put(pageQueue, (None, e), stop)
+        return
+    queue_put(pageQueue, (None, None), stop)
+
+
+def queued_pages(pageQueue):
+    ''' Yield (page, root) from a queue filled by fetch_pages until it is done '''
+    while True:
+        page, root = pageQueue.get()
+        if page is None:
+            # Pass on any download error to the caller
+            if root is not None:
+                raise root
+            return
+        yield page, root
 
 
 class ArfcomThread():
@@ -138,33 +324,36 @@ class ArfcomThread():
     def __init__(self, databaseName) -> None:
         ''' Init an 'ArfcomThread' object from a database filename '''
         self.database = databaseName
-        # Load the database
-        conn = sqlite3.connect(databaseName)
-        df = pd.read_sql(sql="SELECT * FROM posts",
-                         con=conn, parse_dates=['time'])
-
-        # Print top posters
-        self.printTopPosters(df)
-        # Plot top posters
-        self.plotPostsPerDay(df)
-
-    def getTopPosters(self, threadDataFrame) -> list:
-        ''' Return a list of the top 10 posters and number of posts for current thread '''
-        topposters = threadDataFrame['author'].value_counts()
-        return topposters[0:10]
-
-    def printTopPosters(self, df) -> None:
+
+    def getTopPosters(self) -> pd.Series:
+        ''' Return the top 10 posters and number of posts for current thread '''
+        with closing(sqlite3.connect(self.database)) as conn:
+            topposters = pd.read_sql(
+                sql="SELECT author, COUNT(*) AS posts FROM posts GROUP BY author ORDER BY posts DESC LIMIT 10",
+                con=conn, index_col='author')
+        return topposters['posts']
+
+    def printTopPosters(self) -> None:
         ''' Prints out list of top posters '''
         print(
-            f'Top posters in {self.database.split(".")[0]}:\n{self.getTopPosters(df)}')
-
-    def plotPostsPerDay(self, threadDataFrame) -> None:
+            f'Top posters in {self.database.split(".")[0]}:\n{self.getTopPosters()}')
+
+    def getPostsPerDay(self) -> pd.Series:
+        ''' Return the number of posts on each day of the current thread '''
+        # Only the post times are needed, so leave the post text in the database
+        with closing(sqlite3.connect(self.database)) as conn:
+            threadDataFrame = pd.read_sql(sql="SELECT time FROM posts",
+                                          con=conn, parse_dates=['time'])
+        times = threadDataFrame['time'].values
+
+        # Here we extract the posts per day by truncating each time to its day
+        # and counting the unique days, which also leaves them in date order
+        days, counts = np.unique(times.astype('datetime64[D]'), return_counts=True)
+        return pd.Series(counts, index=pd.DatetimeIndex(days, name='date'), name='posts')
+
+    def plotPostsPerDay(self) -> None:
         ''' Create a plot of posts per day for the current thread '''
-        threadDataFrame['date'] = pd.to_datetime(threadDataFrame['time'])
-
-        # Here we extract the posts per day using datetime, and value_counts over the days
-        ppd = threadDataFrame['date'].dt.floor(
-            'd').value_counts().rename_axis('date')
+        ppd = self.getPostsPerDay()
 
         # Plot colors used - can change as needed
         linecolor = sb.color_palette('Paired')[1]  # Dark2
@@ -188,56 +377,80 @@ class ArfcomThread():
         if not dbName:
             dbName = f'{threadPage.split("/")[-3]}.db'
 
+        # Share one session so pages reuse pooled keep-alive connections.
+        # Every page is on the same host, so a single pool with a connection
+        # per fetch worker is enough
         session = requests.Session()
+        # Rate limits and server errors are retried, honouring Retry-After
+        retries = Retry(total=3, backoff_factor=0.3,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=FETCH_WORKERS,
+                              max_retries=retries)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                'User-Agent': 'arfcomThreadAnalyzer',
+                                'Connection': 'keep-alive'})
         sqlName = f'{dbName}.db'
         sqlCon = sql_connection(sqlName)
-
-        # Create sql table
-        sql_table(sqlCon)
-
-        # init our lastPage variable to 1000 before finding the actual number of pages
-        lastPage = 1000
-
-        page = 1
-        print('Beginning download and processing...')
-
-        # Loop while we haven't reached the end of the thread pages
-        while page <= lastPage:
-            # Simple output while running
-            if page % 10 == 0:
-                print('Analyzing page', page)
-
-            # First page has different config than remainder
-            if page == 1:
-                url = threadPage
-            else:
-                url = f'{threadPage}?page={page}'
-
-            # Get html data from page
-            response = session.get(url)
-
-            # Analyze data
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            if page == 1:
-                # get last page
-                lastPage = int(
-                    soup.find('select', class_='pages').text.strip().split()[-1])
-                print(f'There are a total of {lastPage} pages to analyze')
-
-            divsFound = soup.find_all('div', class_='expanded row')
-
-            # Loop over possible posts
-            for post in divsFound:
-                if post:
-                    # Create post instance
-                    newpost = Post(post, pagenum=page)
-                    # Double check all post components are present and insert into db
-                    if newpost.id and newpost.author and newpost.time and newpost.text:
-                        postEntities = (newpost.id, newpost.author,
-                                        newpost.time, newpost.text, newpost.page)
-                        sql_insert(sqlCon, postEntities)
-            page += 1
+        # Close the connection even if the download fails, it holds an
+        # exclusive lock on the database until it is closed
+        with closing(sqlCon):
+            sql_pragmas(sqlCon)
+            # One cursor is used for every statement of the download
+            sqlCur = sqlCon.cursor()
+
+            # Create sql table
+            sql_table(sqlCur)
+
+            # Posts waiting to be written to the database
+            buffer: list[tuple] = []
+
+            print('Beginning download and processing...')
+
+            # Phase 1: get the first page so we know how many pages are in the thread
+            root = fetch_page(session, threadPage)
+
+            # get last page
+            lastPage = int(
+                _PAGES_XP(root)[0].text_content().strip().split()[-1])
+            print(f'There are a total of {lastPage} pages to analyze')
+
+            # Phase 2: start downloading and parsing the remaining pages on a
+            # background thread right away. They are handed back in page order, so
+            # the next pages download while posts are taken from the current one
+            pageQueue = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+            stop = threading.Event()
+            fetcher = threading.Thread(target=fetch_pages, daemon=True,
+                                       args=(session, threadPage, range(2, lastPage + 1), pageQueue, stop))
+            fetcher.start()
+
+            # Post extraction and database writes stay on this thread
+            try:
+                buffer.extend(page_posts(root, 1))
+                for page, root in queued_pages(pageQueue):
+                    # Simple output while running
+                    if page % 10 == 0:
+                        print('Analyzing page', page)
+
+                    buffer.extend(page_posts(root, page))
+
+                    # Flush the buffer once it is large enough
+                    if len(buffer) >= INSERT_BATCH_SIZE:
+                        sql_insert(sqlCur, buffer)
+                        buffer.clear()
+            finally:
+                # Let the fetcher exit if we stopped reading pages early
+                stop.set()
+
+            # Write whatever is left over
+            sql_insert(sqlCur, buffer)
+            buffer.clear()
+
+            # Index the analysis columns now that the bulk load is done
+            sql_index(sqlCur)
         print('Completed webpage parsing')
 
         # Return an ArfcomThread
@@ -255,4 +468,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # Create ArfcomThread using download classmethod with html string
-    ArfcomThread.download(args.thread_link, args.databaseName)
+    thread = ArfcomThread.download(args.thread_link, args.databaseName)
+
+    # Print top posters and plot posts per day
+    thread.printTopPosters()
+    thread.plotPostsPerDay()